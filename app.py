@@ -9,15 +9,23 @@ Secrets expected in Streamlit:
 """
 import json
 import base64
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Mapping
 from typing import List, Dict, Optional
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Optional Google client libraries (used only if business_profile credentials are provided)
 try:
     from google.oauth2 import service_account
     from googleapiclient.discovery import build
+    from googleapiclient.http import build_http
+    import google_auth_httplib2
     GOOGLE_CLIENT_AVAILABLE = True
 except Exception:
     GOOGLE_CLIENT_AVAILABLE = False
@@ -35,32 +43,55 @@ and helps you prepare and post replies. Posting replies requires Business Profil
 # -----------------------
 # Helpers & reply templates
 # -----------------------
-def gen_reply_by_rating(first_name: str, rating: int, extra: str = "") -> str:
-    star_part = f"{rating} star" if rating == 1 else f"{rating} stars"
-    if rating >= 5:
-        start = f"Hi {first_name}, Thank you for the {star_part} review. We are delighted you had an excellent experience."
-    elif rating == 4:
-        start = f"Hi {first_name}, Thank you for the {star_part} review. We appreciate the feedback."
-    elif rating == 3:
-        start = f"Hi {first_name}, Thank you for the {star_part} review. We appreciate your honest feedback and will work to improve."
-    elif rating == 2:
-        start = f"Hi {first_name}, We're sorry your experience was not ideal. Thank you for the {star_part} review — we'll use this to improve."
-    else:  # 1 star
-        start = f"Hi {first_name}, We're very sorry you had a bad experience. Thank you for the {star_part} review — please contact us so we can make it right."
+_REPLY_TEMPLATES: Dict[int, str] = {
+    5: "Hi {name}, Thank you for the {star_part} review. We are delighted you had an excellent experience.",
+    4: "Hi {name}, Thank you for the {star_part} review. We appreciate the feedback.",
+    3: "Hi {name}, Thank you for the {star_part} review. We appreciate your honest feedback and will work to improve.",
+    2: "Hi {name}, We're sorry your experience was not ideal. Thank you for the {star_part} review — we'll use this to improve.",
+    1: "Hi {name}, We're very sorry you had a bad experience. Thank you for the {star_part} review — please contact us so we can make it right.",
+}
+_STAR_PART: Dict[int, str] = {i: f"{i} star" if i == 1 else f"{i} stars" for i in range(1, 6)}
+_REPLY_SIGNATURE = "\n\nTeam Salasar Services"
+
 
+def gen_reply_by_rating(first_name: str, rating: int, extra: str = "") -> str:
+    star_part = _STAR_PART.get(rating) or f"{rating} stars"
+    template = _REPLY_TEMPLATES[min(max(rating, 1), 5)]
+    start = template.format(name=first_name, star_part=star_part)
     if extra:
-        return f"{start} {extra}\n\nTeam Salasar Services"
-    else:
-        return f"{start}\n\nTeam Salasar Services"
+        return f"{start} {extra}{_REPLY_SIGNATURE}"
+    return start + _REPLY_SIGNATURE
+
+
+# Fetched reviews are cached for this many seconds, shared across reruns and sessions.
+REVIEWS_CACHE_TTL = 300
 
 
 # -----------------------
 # Places API (read-only)
 # -----------------------
+# Streamlit re-executes this script on every rerun, so the pooled session is held in
+# st.cache_resource to keep its keep-alive connections across reruns and sessions.
+@st.cache_resource
+def _http_session() -> requests.Session:
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+        ),
+    )
+    return session
+
+
+@st.cache_data(ttl=REVIEWS_CACHE_TTL, show_spinner=False)
 def get_reviews_places(place_id: str, api_key: str) -> List[Dict]:
     url = "https://maps.googleapis.com/maps/api/place/details/json"
-    params = {"place_id": place_id, "fields": "name,rating,reviews", "key": api_key}
-    r = requests.get(url, params=params, timeout=20)
+    # Only the reviews are read; Place Details cannot narrow fields inside "reviews".
+    params = {"place_id": place_id, "fields": "reviews", "key": api_key}
+    r = _http_session().get(url, params=params, headers={"Accept-Encoding": "gzip"}, timeout=20)
     r.raise_for_status()
     data = r.json()
     if data.get("status") != "OK":
@@ -83,37 +114,105 @@ def get_reviews_places(place_id: str, api_key: str) -> List[Dict]:
 # -----------------------
 # Business Profile API (full access)
 # -----------------------
+class _DiscoveryDocCache:
+    """In-memory discovery document store, passed to googleapiclient's build() as `cache`."""
+
+    def __init__(self):
+        self._docs: Dict[str, str] = {}
+
+    def get(self, url):
+        return self._docs.get(url)
+
+    def set(self, url, content):
+        self._docs[url] = content
+
+
+# Only the discovery document and credentials are shared across sessions. Each session
+# builds its own service, because the service's httplib2 transport is not thread-safe.
+@st.cache_resource(show_spinner=False)
+def _discovery_doc_cache() -> _DiscoveryDocCache:
+    return _DiscoveryDocCache()
+
+
+@st.cache_resource(show_spinner=False)
+def _bp_credentials(sa_info_json: str, scopes: tuple):
+    return service_account.Credentials.from_service_account_info(json.loads(sa_info_json), scopes=list(scopes))
+
+
 def create_business_profile_service_from_service_account(sa_info: Dict, scopes: List[str]):
     if not GOOGLE_CLIENT_AVAILABLE:
         raise RuntimeError("googleapiclient or google-auth packages are not installed. See requirements.txt.")
-    creds = service_account.Credentials.from_service_account_info(sa_info, scopes=scopes)
-    service = build("mybusiness", "v4", credentials=creds, cache_discovery=False)
-    return service
+    creds = _bp_credentials(json.dumps(dict(sa_info), sort_keys=True), tuple(scopes))
+    # mybusiness v4 is not bundled with googleapiclient, so the document is fetched once and
+    # then served from the shared cache.
+    return build(
+        "mybusiness", "v4", credentials=creds,
+        static_discovery=False, cache_discovery=True, cache=_discovery_doc_cache(),
+    )
 
 
 def list_accounts_and_locations(service) -> Dict[str, List[Dict]]:
     accounts = {}
+    errors = []
     resp = service.accounts().list().execute()
-    for acct in resp.get("accounts", []):
-        acct_name = acct["name"]
-        locs = []
-        loc_resp = service.accounts().locations().list(parent=acct_name).execute()
-        for loc in loc_resp.get("locations", []):
-            locs.append({"name": loc.get("name"), "storeCode": loc.get("storeCode")})
-        accounts[acct_name] = locs
+    acct_names = [acct["name"] for acct in resp.get("accounts", [])]
+    if not acct_names:
+        return accounts
+
+    def _on_locations(request_id, loc_resp, exception, acct_name):
+        if exception is not None:
+            errors.append(exception)
+            return
+        accounts[acct_name].extend(
+            {"name": loc.get("name"), "storeCode": loc.get("storeCode")}
+            for loc in (loc_resp or {}).get("locations", [])
+        )
+
+    # All locations().list() calls go out as one multipart batch request.
+    batch = service.new_batch_http_request()
+    for acct_name in acct_names:
+        accounts[acct_name] = []
+        batch.add(
+            service.accounts().locations().list(parent=acct_name),
+            callback=functools.partial(_on_locations, acct_name=acct_name),
+        )
+    batch.execute()
+    if errors:
+        raise errors[0]
     return accounts
 
 
-def list_reviews_businessprofile(service, location_name: str) -> List[Dict]:
+# Maximum page size accepted by the Business Profile reviews.list endpoint.
+REVIEWS_PAGE_SIZE = 50
+# starRating in My Business API is an uppercase enum like "FIVE" or "ONE".
+_STAR_MAP: Dict[str, Optional[int]] = {
+    "ONE": 1, "TWO": 2, "THREE": 3, "FOUR": 4, "FIVE": 5, "STAR_RATING_UNSPECIFIED": None,
+}
+# Partial-response mask: only the review fields read below, plus the paging token.
+REVIEWS_FIELDS = "reviews(reviewId,name,reviewer/displayName,starRating,comment,createTime,reviewReply/comment),nextPageToken"
+
+
+# The leading underscore tells st.cache_data not to hash the service object; the
+# credentials fingerprint keys the cache per service account instead.
+@st.cache_data(ttl=REVIEWS_CACHE_TTL, show_spinner=False)
+def _fetch_reviews_raw(_service, location_name: str, credentials_fingerprint: str) -> List[Dict]:
+    # pageToken values are opaque and only returned by the previous page, so pages are
+    # walked sequentially using the maximum page size to keep round-trips to a minimum.
+    raw_reviews = []
+    page_token = None
+    while True:
+        resp = _service.accounts().locations().reviews().list(
+            parent=location_name, pageSize=REVIEWS_PAGE_SIZE, pageToken=page_token, fields=REVIEWS_FIELDS
+        ).execute()
+        raw_reviews.extend(resp.get("reviews", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            break
+
     reviews = []
-    resp = service.accounts().locations().reviews().list(parent=location_name).execute()
-    for r in resp.get("reviews", []):
-        # starRating in My Business API is like "FIVE" or "ONE". Convert to number if possible.
+    for r in raw_reviews:
         star = r.get("starRating")
-        rating = None
-        if isinstance(star, str):
-            mapping = {"ONE": 1, "TWO": 2, "THREE": 3, "FOUR": 4, "FIVE": 5}
-            rating = mapping.get(star.upper())
+        rating = _STAR_MAP.get(star) if isinstance(star, str) else None
         reviews.append({
             "reviewId": r.get("reviewId"),
             "name": r.get("name"),
@@ -126,12 +225,82 @@ def list_reviews_businessprofile(service, location_name: str) -> List[Dict]:
     return reviews
 
 
-def post_reply_businessprofile(service, review_name: str, comment: str) -> Dict:
+def _credentials_fingerprint(service) -> str:
+    creds = getattr(getattr(service, "_http", None), "credentials", None)
+    return getattr(creds, "service_account_email", None) or ""
+
+
+def list_reviews_businessprofile(service, location_name: str) -> List[Dict]:
+    return _fetch_reviews_raw(service, location_name, _credentials_fingerprint(service))
+
+
+def clear_reviews_cache() -> None:
+    get_reviews_places.clear()
+    _fetch_reviews_raw.clear()
+
+
+# Max concurrent reply POSTs; kept small to stay well within Business Profile quotas.
+POST_MAX_WORKERS = 8
+
+_thread_local = threading.local()
+
+
+def _thread_http(service):
+    # httplib2 (used by googleapiclient) is not thread-safe, so each worker thread gets its own
+    # authorized transport built from the service's credentials. It is reused for keep-alive;
+    # build_http() keeps googleapiclient's default socket timeout.
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(service._http.credentials, http=build_http())
+        _thread_local.http = http
+    return http
+
+
+def post_reply_businessprofile(service, review_name: str, comment: str, http=None) -> Dict:
     body = {"comment": comment}
-    resp = service.accounts().locations().reviews().reply(name=review_name, body=body).execute()
+    resp = service.accounts().locations().reviews().reply(name=review_name, body=body).execute(http=http)
     return resp
 
 
+def post_replies_businessprofile(service, items: List[Dict], max_workers: int = POST_MAX_WORKERS) -> List[Dict]:
+    """Post replies concurrently. Each item needs 'review_name' and 'reply_text'; results keep input order."""
+    def _post_one(item: Dict) -> Dict:
+        review_id = item.get("reviewId")
+        try:
+            resp = post_reply_businessprofile(service, item["review_name"], item["reply_text"], http=_thread_http(service))
+            return {"status": "posted", "reviewId": review_id, "response": resp}
+        except Exception as e:
+            return {"status": "failed", "reviewId": review_id, "error": str(e)}
+
+    results: Dict[int, Dict] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futs = {ex.submit(_post_one, item): idx for idx, item in enumerate(items)}
+        for f in as_completed(futs):
+            results[futs[f]] = f.result()
+    return [results[idx] for idx in range(len(items))]
+
+
+# -----------------------
+# Secrets parsing
+# -----------------------
+def _sa_cache_key(raw) -> str:
+    # st.secrets sections are mappings rather than plain strings; canonicalize them so
+    # the cache key is a stable, hashable string.
+    if isinstance(raw, Mapping):
+        return json.dumps(dict(raw), sort_keys=True)
+    return raw
+
+
+@st.cache_data(show_spinner=False)
+def _load_sa_info(raw: str) -> Dict:
+    """Parse the service account secret (JSON or base64-encoded JSON) once per process."""
+    try:
+        decoded = base64.b64decode(raw).decode("utf-8")
+        return json.loads(decoded)
+    except Exception:
+        return json.loads(raw)
+
+
 # -----------------------
 # Streamlit UI & flow
 # -----------------------
@@ -143,14 +312,7 @@ sa_json_raw = secrets.get("business_service_account") if secrets else None
 service_account_info = None
 if sa_json_raw:
     try:
-        if isinstance(sa_json_raw, dict):
-            service_account_info = sa_json_raw
-        else:
-            try:
-                decoded = base64.b64decode(sa_json_raw).decode("utf-8")
-                service_account_info = json.loads(decoded)
-            except Exception:
-                service_account_info = json.loads(sa_json_raw)
+        service_account_info = _load_sa_info(_sa_cache_key(sa_json_raw))
     except Exception as e:
         st.error(f"Could not parse service account JSON from secrets: {e}")
         service_account_info = None
@@ -160,7 +322,9 @@ st.write("Business Profile Service Account present:", bool(service_account_info)
 st.header("Fetch method")
 mode = st.radio("Fetch method:", ("Places API (API key, limited, read-only)", "Business Profile API (full, requires service account)"))
 
-reviews: List[Dict] = []
+if st.button("Refresh (clear cached reviews)"):
+    clear_reviews_cache()
+    st.session_state.pop("reviews", None)
 
 if mode.startswith("Places"):
     if not google_api_key:
@@ -171,6 +335,7 @@ if mode.startswith("Places"):
             try:
                 with st.spinner("Fetching reviews from Places API..."):
                     reviews = get_reviews_places(place_id.strip(), google_api_key)
+                st.session_state["reviews"] = reviews
                 st.success(f"Fetched {len(reviews)} reviews (Places API returns only recent reviews).")
             except Exception as e:
                 st.error(f"Error: {e}")
@@ -203,11 +368,13 @@ else:
                         with st.spinner("Fetching reviews..."):
                             service = st.session_state.get("bp_service")
                             reviews = list_reviews_businessprofile(service, loc_choice)
+                            st.session_state["reviews"] = reviews
                             st.success(f"Fetched {len(reviews)} reviews.")
                     except Exception as e:
                         st.error(f"Error fetching reviews: {e}")
 
-# Show and prepare replies
+# Show and prepare replies. Reviews persist in session_state so they survive reruns.
+reviews: List[Dict] = st.session_state.get("reviews") or []
 if reviews:
     st.header("Unanswered reviews & replies")
     unanswered = [r for r in reviews if not r.get("reply")]
@@ -216,56 +383,72 @@ if reviews:
     default_extra = st.text_area("Optional extra text to append to every reply", value="", height=80)
     to_post = []
 
-    for i, rev in enumerate(unanswered):
+    # Widgets inside a form only trigger a rerun on submit, not on every keystroke/toggle.
+    with st.form("reply_form", clear_on_submit=False):
+        for i, rev in enumerate(unanswered):
+            st.markdown("---")
+            author = rev.get("author_name") or "Customer"
+            rating = rev.get("rating") or 4
+            text = rev.get("text") or ""
+            st.write(f"Review #{i+1} — {author} ({rating} stars)")
+            st.write(text)
+            first_name = author.split()[0] if isinstance(author, str) and author.strip() else "there"
+            preview = gen_reply_by_rating(first_name, int(rating), extra=default_extra)
+            # Keyed by review identity so edits stay with their review when the list changes.
+            widget_key = rev.get("reviewId") or i
+            custom = st.text_area(f"Reply text (editable) — review #{i+1}", value=preview, key=f"reply_{widget_key}", height=140)
+            post_checkbox = st.checkbox("Post reply for this review", key=f"post_{widget_key}", value=True)
+            if post_checkbox:
+                to_post.append({"review": rev, "reply_text": custom})
+
         st.markdown("---")
-        author = rev.get("author_name") or "Customer"
-        rating = rev.get("rating") or 4
-        text = rev.get("text") or ""
-        st.write(f"Review #{i+1} — {author} ({rating} stars)")
-        st.write(text)
-        first_name = author.split()[0] if isinstance(author, str) and author.strip() else "there"
-        preview = gen_reply_by_rating(first_name, int(rating), extra=default_extra)
-        custom = st.text_area(f"Reply text (editable) — review #{i+1}", value=preview, key=f"reply_{i}", height=140)
-        post_checkbox = st.checkbox("Post reply for this review", key=f"post_{i}", value=True)
-        if post_checkbox:
-            to_post.append({"review": rev, "reply_text": custom})
-
-    st.markdown("---")
-    st.write("Selected to post:", len(to_post))
-
-    if st.button("Post selected replies now"):
+        submitted = st.form_submit_button("Post selected replies now")
+
+    if submitted:
+        st.write("Selected to post:", len(to_post))
         service = st.session_state.get("bp_service")
         if not service:
             st.error("No Business Profile service available. Please connect using the Business Profile flow.")
         else:
-            results = []
-            for item in to_post:
+            # One slot per to_post entry so results line up with the selected reviews.
+            results: List[Optional[Dict]] = [None] * len(to_post)
+            pending = []
+            pending_idx = []
+            # Fallback location for reviews without a 'name': the first single-location account.
+            accounts = st.session_state.get("bp_accounts", {})
+            fallback_location = next((locs[0]["name"] for locs in accounts.values() if len(locs) == 1), None)
+            for idx, item in enumerate(to_post):
                 rev = item["review"]
                 reply_text = item["reply_text"]
                 review_id = rev.get("reviewId")
                 if not review_id:
-                    results.append({"status": "skipped", "reason": "no reviewId"})
+                    results[idx] = {"status": "skipped", "reason": "no reviewId"}
                     continue
                 # Construct review resource name. Prefer 'name' if present.
-                if rev.get("name"):
-                    review_name = rev.get("name")
-                else:
-                    # Fallback: try to use the single connected location if available
-                    accounts = st.session_state.get("bp_accounts", {})
-                    review_name = None
-                    for acct, locs in accounts.items():
-                        if len(locs) == 1:
-                            review_name = f"{locs[0]['name']}/reviews/{review_id}"
-                            break
+                review_name = rev.get("name") or (
+                    f"{fallback_location}/reviews/{review_id}" if fallback_location else None
+                )
                 if not review_name:
-                    results.append({"status": "skipped", "reason": "cannot construct review resource name"})
+                    results[idx] = {"status": "skipped", "reason": "cannot construct review resource name"}
                     continue
-                try:
-                    with st.spinner("Posting reply..."):
-                        resp = post_reply_businessprofile(service, review_name, reply_text)
-                    results.append({"status": "posted", "reviewId": review_id, "response": resp})
-                except Exception as e:
-                    results.append({"status": "failed", "reviewId": review_id, "error": str(e)})
+                pending.append({"reviewId": review_id, "review_name": review_name, "reply_text": reply_text})
+                pending_idx.append(idx)
+            if pending:
+                with st.spinner(f"Posting {len(pending)} replies..."):
+                    for idx, res in zip(pending_idx, post_replies_businessprofile(service, pending)):
+                        results[idx] = res
+                # Posted replies change the review data, so the next fetch must not hit the cache.
+                clear_reviews_cache()
+                # Mark posted reviews as answered so they are not offered (and re-sent) again.
+                posted = {
+                    item["reviewId"]: item["reply_text"]
+                    for item, idx in zip(pending, pending_idx)
+                    if results[idx]["status"] == "posted"
+                }
+                st.session_state["reviews"] = [
+                    {**r, "reply": posted[r.get("reviewId")]} if r.get("reviewId") in posted else r
+                    for r in reviews
+                ]
             st.subheader("Results")
             st.json(results)
 